@@ -1,15 +1,12 @@
 import streamlit as st
-import pandas as pd      
-from langchain_openai import ChatOpenAI  
 from langchain_community.agent_toolkits import SQLDatabaseToolkit  
-from langchain_core.messages import HumanMessage  
+from langchain_core.messages import AIMessageChunk, HumanMessage  
 from langgraph.prebuilt import create_react_agent  
-from langchain_community.utilities import SQLDatabase          
-from sqlalchemy import create_engine    
+from csvquery_common import (
+    file_digest, get_llm, load_css, load_database, log_prompt_cache_usage,
+    render_chat_history,
+)
 import os
-import tempfile
-import plotly.express as px
-import plotly.graph_objects as go
 from langgraph.checkpoint.memory import MemorySaver 
 
 
@@ -23,102 +20,20 @@ st.set_page_config(
 )
 
 # Custom CSS for styling
-st.markdown("""
-<style>
-    .main-header {
-        text-align: center;
-        padding: 2rem 0;
-        background: linear-gradient(90deg, #667eea 0%, #764ba2 100%);
-        border-radius: 10px;
-        margin-bottom: 2rem;
-        color: white;
-    }
-    .feature-card {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        padding: 1.5rem;
-        border-radius: 10px;
-        color: white;
-        text-align: center;
-        margin: 0.5rem 0;
-        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-    }
-    .upload-section {
-        background: #f8f9fa;
-        padding: 2rem;
-        border-radius: 10px;
-        border: 2px dashed #667eea;
-        text-align: center;
-        margin: 1rem 0;
-    }
-    .chat-container {
-        background: white;
-        padding: 1rem;
-        border-radius: 10px;
-        box-shadow: 0 2px 4px rgba(0, 0, 0, 0.1);
-        margin: 1rem 0;
-    }
-    .stButton > button {
-        background: linear-gradient(90deg, #667eea 0%, #764ba2 100%);
-        color: white;
-        border: none;
-        border-radius: 25px;
-        padding: 0.5rem 2rem;
-        font-weight: bold;
-    }
-    .quick-action-btn {
-        background: linear-gradient(135deg, #ff6b6b, #ee5a6f);
-        color: white;
-        padding: 0.8rem 1.5rem;
-        border-radius: 25px;
-        border: none;
-        font-weight: bold;
-        margin: 0.2rem;
-        cursor: pointer;
-    }
-    .sidebar-content {
-        background: #2c3e50;
-        color: white;
-        padding: 1rem;
-        border-radius: 10px;
-        margin: 0.5rem 0;
-    }
-</style>
-""", unsafe_allow_html=True)
+st.markdown(f"<style>{load_css()}</style>", unsafe_allow_html=True)
 
-def create_db_from_file(file_path, table_name=None):
-    """
-    Create SQLite database from CSV or Excel file.
-    """
-    filename = os.path.splitext(os.path.basename(file_path))[0]
-    
-    if table_name is None:
-        table_name = filename.lower().replace(' ', '_').replace('-', '_')
-    
-    db_filename = f"{filename}.db"
-    file_extension = os.path.splitext(file_path)[1].lower()
-    
-    if file_extension == '.csv':
-        df = pd.read_csv(file_path)
-    elif file_extension in ['.xlsx', '.xls']:
-        df = pd.read_excel(file_path)
-    else:
-        raise ValueError(f"Unsupported file format: {file_extension}")
-    
-    engine = create_engine(f"sqlite:///{db_filename}")
-    df.to_sql(table_name, engine, index=False, if_exists='replace')
-    db = SQLDatabase(engine=engine)
-    
-    return db, df
+# Keeps this app's on-disk database files apart from the other app's
+APP_NAME = os.path.splitext(os.path.basename(__file__))[0]
 
 def initialize_agent(db):
     """Initialize the SQL agent"""
-    llm = ChatOpenAI(model="gpt-4o", temperature=0)
+    llm = get_llm()
     toolkit = SQLDatabaseToolkit(db=db, llm=llm)
     tools = toolkit.get_tools()
     
-    system_message = """
+    system_message = f"""
     You are an agent designed to interact with a SQL database.
-    Given an input question, create a syntactically correct SQLite query to run,
+    Given an input question, create a syntactically correct {db.dialect} query to run,
     then look at the results of the query and return the answer. Unless the user
     specifies a specific number of examples they wish to obtain, always limit your
     query to at most 5 results.
@@ -133,34 +48,57 @@ def initialize_agent(db):
     DO NOT make any DML statements (INSERT, UPDATE, DELETE, DROP etc.) to the
     database.
 
-    To start you should ALWAYS look at the tables in the database to see what you
-    can query. Do NOT skip this step.
+    The schema and a few sample rows of every table are listed below, so you
+    can write queries straight away without looking the tables up first.
 
-    Then you should query the schema of the most relevant tables.
-    """ 
+    When a question needs several independent queries, request all of those tool
+    calls in the same turn so they can run in parallel.
+    """
+    # Keep the schema in the leading system message so every call shares the same
+    # static prefix, which OpenAI caches automatically once it passes 1024 tokens
+    system_message += f"\n    TABLE SCHEMAS AND SAMPLE ROWS:\n{db.get_table_info()}\n"
+    
     agent_executor = create_react_agent(llm, tools, prompt=system_message, checkpointer= MemorySaver())
     return agent_executor
 
-def query_agent(agent, question):
-    """Query the agent with a question"""
+def query_agent_stream(agent, question):
+    """Query the agent with a question, yielding the answer as it is generated"""
     try:
+        parts = []
+        message_id = None
         config = {"configurable": {"thread_id": "thread-1"}} 
-        result = agent.invoke({"messages": [{"role": "user", "content": question}]},config)
-        return result["messages"][-1].content
+        stream = agent.stream({"messages": [{"role": "user", "content": question}]}, config, stream_mode="messages")
+        for chunk, metadata in stream:
+            # Only pass on the agent's own replies, not tool output or the query checker's LLM calls
+            if metadata.get("langgraph_node") != "agent" or not isinstance(chunk, AIMessageChunk):
+                continue
+            if chunk.usage_metadata:
+                log_prompt_cache_usage(chunk.usage_metadata)
+            if not chunk.content:
+                continue
+            if parts and chunk.id != message_id:
+                parts.append("\n\n")
+                yield "\n\n"
+            message_id = chunk.id
+            parts.append(chunk.content)
+            yield chunk.content
     except Exception as e:
-        return f"Error: {str(e)}"
+        # Keep an error that cuts an answer short out of its last paragraph
+        if parts:
+            yield "\n\n"
+        yield f"Error: {str(e)}"
 
 # Initialize session state
 if 'db' not in st.session_state:
     st.session_state.db = None
 if 'agent' not in st.session_state:
     st.session_state.agent = None
-if 'df' not in st.session_state:
-    st.session_state.df = None
+if 'meta' not in st.session_state:
+    st.session_state.meta = None
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
-if 'question_counter' not in st.session_state:
-    st.session_state.question_counter = 0
+if 'upload_digests' not in st.session_state:
+    st.session_state.upload_digests = {}
 
 # Sidebar
 with st.sidebar:
@@ -185,24 +123,34 @@ with st.sidebar:
         type=['csv', 'xlsx', 'xls'],
         help="Upload CSV or Excel files"
     )
+    on_disk = st.checkbox(
+        "💾 Store database on disk",
+        help="Keep the table in a temporary file instead of memory, for files too large to hold in RAM"
+    )
     
     if uploaded_file is not None:
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_file_path = tmp_file.name
+        # Reruns keep the same upload, so hash it once and remember only the current one
+        upload_digests = st.session_state.upload_digests
+        if uploaded_file.file_id not in upload_digests:
+            upload_digests.clear()
+            upload_digests[uploaded_file.file_id] = file_digest(uploaded_file)
+        digest = upload_digests[uploaded_file.file_id]
         
         try:
-            db, df = create_db_from_file(tmp_file_path)
+            db, meta = load_database(APP_NAME, digest, uploaded_file.name, uploaded_file, on_disk)
             st.session_state.db = db
-            st.session_state.df = df
-            st.session_state.agent = initialize_agent(db)
+            # Only a summary is kept; the data itself lives in the database
+            st.session_state.meta = meta
+            # Each session builds its own agent, so its MemorySaver only holds this
+            # session's conversation; keep it until a different upload comes in
+            agent_key = (digest, uploaded_file.name, on_disk)
+            if st.session_state.get('agent_key') != agent_key:
+                st.session_state.agent = initialize_agent(db)
+                st.session_state.agent_key = agent_key
             st.success(f"✅ File uploaded successfully!")
-            st.info(f"📊 {len(df)} rows, {len(df.columns)} columns")
+            st.info(f"📊 {meta['rows']} rows, {len(meta['cols'])} columns")
         except Exception as e:
             st.error(f"❌ Error processing file: {str(e)}")
-        finally:
-            os.unlink(tmp_file_path)
     
     if st.button("🗑️ Clear Conversation"):
         st.session_state.chat_history = []
@@ -268,41 +216,31 @@ else:
     with st.expander("📊 Data Overview", expanded=False):
         col1, col2 = st.columns(2)
         with col1:
-            st.metric("Total Rows", len(st.session_state.df))
-            st.metric("Total Columns", len(st.session_state.df.columns))
+            st.metric("Total Rows", st.session_state.meta['rows'])
+            st.metric("Total Columns", len(st.session_state.meta['cols']))
         with col2:
             st.write("**Column Names:**")
-            st.write(", ".join(st.session_state.df.columns.tolist()))
+            st.write(", ".join(st.session_state.meta['cols']))
         
         st.write("**Data Preview:**")
-        st.dataframe(st.session_state.df.head(), use_container_width=True)
+        st.dataframe(st.session_state.meta['preview'], use_container_width=True)
     
     # Chat interface
     st.markdown("### 💬 Ask Questions About Your Data")
     
-    # Display chat history
-    for i, (question, answer) in enumerate(st.session_state.chat_history):
-        with st.container():
-            st.markdown(f"**You:** {question}")
-            st.markdown(f"**AI Assistant:** {answer}")
-            st.markdown("---")
+    render_chat_history()
     
-    # Input area
-    user_question = st.text_input(
-        "Enter your question:",
-        placeholder="e.g., What are the top 5 sales by region?",
-        key=f"user_input_{st.session_state.question_counter}"
-    )
-    ask_button = st.button("Ask", type="primary", use_container_width=False)
+    # Input area; the new turn is drawn in place, so no rerun is needed afterwards
+    user_question = st.chat_input("Enter your question, e.g. What are the top 5 sales by region?")
     
     # Process question
-    if ask_button and user_question and st.session_state.agent:
-        with st.spinner("🤔 Thinking..."):
-            answer = query_agent(st.session_state.agent, user_question)
-            st.session_state.chat_history.append((user_question, answer))
-            # Increment counter to create new input widget
-            st.session_state.question_counter += 1
-            st.rerun()
+    if user_question and st.session_state.agent:
+        with st.chat_message("user"):
+            st.markdown(user_question)
+        with st.chat_message("assistant"):
+            with st.spinner("🤔 Thinking..."):
+                answer = st.write_stream(query_agent_stream(st.session_state.agent, user_question))
+        st.session_state.chat_history.append((user_question, answer))
 
 # Footer
 st.markdown("---")
@@ -0,0 +1,274 @@
+"""
+Styling, chat, upload parsing, database and OpenAI client helpers shared by csvquery_app and csvquery2.
+"""
+import streamlit as st
+import pandas as pd
+from langchain_openai import ChatOpenAI
+from langchain_community.utilities import SQLDatabase
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool, StaticPool
+import atexit
+import collections
+import glob
+import hashlib
+import httpx
+import logging
+import os
+import re
+import tempfile
+import threading
+import uuid
+try:
+    import duckdb
+    from duckdb_engine import ConnectionWrapper
+except ImportError:
+    duckdb = None
+
+logger = logging.getLogger("csvquery")
+# The root logger only shows warnings, so give the apps their own INFO handler.
+# Streamlit re-runs the app script on every interaction, so only attach it once
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+# Number of uploaded databases (and their agents) kept per server process,
+# which also bounds how many on-disk database files are left in the temp dir
+DB_CACHE_SIZE = 8
+
+@st.cache_resource
+def load_css():
+    """Read the app stylesheet once per server process"""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "style.css"), encoding="utf-8") as f:
+        return f.read()
+
+@st.cache_resource
+def get_http_client():
+    """Shared HTTP/2 client, so OpenAI calls reuse pooled keep-alive connections"""
+    return httpx.Client(http2=True, limits=httpx.Limits(max_keepalive_connections=20))
+
+@st.cache_resource
+def get_llm(model="gpt-4o"):
+    """Shared chat model, reused across uploads and turns"""
+    return ChatOpenAI(model=model, temperature=0, stream_usage=True, http_client=get_http_client())
+
+def read_data_file(file, file_name):
+    """
+    Read a CSV or Excel file (a path or file-like object) into a DataFrame.
+
+    The format is taken from file_name's extension.
+    """
+    file_extension = os.path.splitext(file_name)[1].lower()
+
+    if file_extension == '.csv':
+        try:
+            df = pd.read_csv(file, engine='pyarrow', dtype_backend='pyarrow')
+            if df.columns.duplicated().any():
+                # Only the C parser renames repeated headers (a, a.1)
+                raise ValueError("duplicate column names")
+        except (ImportError, ValueError):
+            # Missing pyarrow, or a file its stricter parser rejects (e.g. ragged rows)
+            if hasattr(file, 'seek'):
+                file.seek(0)
+            df = pd.read_csv(file, engine='c', low_memory=False, cache_dates=True)
+    elif file_extension in ['.xlsx', '.xls']:
+        try:
+            # The Rust-based calamine reader is far faster than openpyxl's pure-Python XML parsing
+            df = pd.read_excel(file, engine='calamine', dtype_backend='pyarrow')
+        except ImportError:
+            # Without python-calamine (or pyarrow) let pandas pick openpyxl or xlrd by extension
+            if hasattr(file, 'seek'):
+                file.seek(0)
+            df = pd.read_excel(file)
+    else:
+        raise ValueError(f"Unsupported file format: {file_extension}")
+
+    return df
+
+def create_db_engine(db_path=None):
+    """
+    Create an engine for a DuckDB database, or SQLite if DuckDB isn't installed.
+
+    The database is kept in memory unless a db_path is given.
+    """
+    if duckdb is not None:
+        # DuckDB connections aren't thread-safe, so every pooled connection is its
+        # own cursor on one shared database connection, which also keeps an
+        # in-memory database alive for as long as the engine is referenced
+        base_con = duckdb.connect(db_path or ':memory:')
+        engine = create_engine(
+            "duckdb://", poolclass=QueuePool,
+            creator=lambda: ConnectionWrapper(base_con.cursor())
+        )
+        event.listen(engine, "engine_disposed", lambda engine: base_con.close())
+        return engine
+    # StaticPool hands out one shared connection, which keeps an in-memory
+    # database alive for as long as the engine is referenced
+    return create_engine(
+        f"sqlite:///{db_path}" if db_path else "sqlite://",
+        poolclass=StaticPool, connect_args={"check_same_thread": False}
+    )
+
+def describe_table(engine, table_name):
+    """Row count, column names and a 20-row preview of a table, read from the database"""
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql(f'SELECT COUNT(*) FROM "{table_name}"').scalar()
+    preview = pd.read_sql_query(f'SELECT * FROM "{table_name}" LIMIT 20', engine)
+    return {'rows': rows, 'cols': [str(column) for column in preview.columns], 'preview': preview}
+
+def create_db_from_file(file, file_name, table_name=None, db_path=None):
+    """
+    Create a database from CSV or Excel file.
+
+    Uses DuckDB when it is installed and falls back to SQLite otherwise. The
+    database is kept in memory unless a db_path is given, which must be a path
+    no earlier database used (see db_file_path). Returns the database with a
+    describe_table summary; the parsed DataFrame is dropped once loaded.
+    """
+    filename = os.path.splitext(os.path.basename(file_name))[0]
+    
+    if table_name is None:
+        table_name = re.sub(r'\W+', '_', filename.lower()).strip('_') or 'data'
+    
+    df = read_data_file(file, file_name)
+    # A database file is built under a temporary name and only moved into place
+    # once loaded, so a failed upload never leaves a file without its table
+    build_path = f"{db_path}.{uuid.uuid4().hex[:8]}.tmp" if db_path else None
+    engine = create_db_engine(build_path)
+
+    try:
+        if duckdb is not None:
+            con = engine.raw_connection()
+            # Bulk-load the frame through DuckDB's Arrow scan instead of row-wise INSERTs
+            con.register('tmp_df', df)
+            con.execute(f'CREATE OR REPLACE TABLE "{table_name}" AS SELECT * FROM tmp_df')
+            con.unregister('tmp_df')
+            con.close()
+        else:
+            # WAL only applies to files, in-memory databases keep their journal in RAM.
+            # No exclusive lock, since a database file may be reopened by a later upload
+            pragmas = (
+                "synchronous=OFF", "temp_store=MEMORY", "cache_size=-65536",
+                "journal_mode=WAL" if db_path else "journal_mode=MEMORY",
+            )
+            # Multi-row INSERTs in a single transaction; the chunk size keeps each
+            # statement under SQLite's 32766 bound-parameter limit
+            with engine.begin() as conn:
+                for pragma in pragmas:
+                    conn.exec_driver_sql(f"PRAGMA {pragma}")
+                df.to_sql(
+                    table_name, conn, index=False, if_exists='replace', method='multi',
+                    chunksize=max(1, 32000 // max(len(df.columns), 1))
+                )
+    except Exception:
+        engine.dispose()
+        if build_path:
+            remove_db_files([build_path])
+        raise
+
+    if db_path:
+        # Closing the engine flushes the write-ahead log into the file before it is moved
+        engine.dispose()
+        os.replace(build_path, db_path)
+        engine = create_db_engine(db_path)
+    db = SQLDatabase(engine=engine)
+    
+    return db, describe_table(engine, table_name)
+
+def open_db_file(db_path):
+    """Open a database file written by an earlier upload, with its table summary"""
+    engine = create_db_engine(db_path)
+    try:
+        db = SQLDatabase(engine=engine)
+        return db, describe_table(engine, db.get_usable_table_names()[0])
+    except Exception:
+        engine.dispose()
+        raise
+
+def log_prompt_cache_usage(usage):
+    """Log how many prompt tokens of a model call were served from OpenAI's prompt cache"""
+    cached_tokens = usage.get("input_token_details", {}).get("cache_read", 0)
+    logger.info("Prompt tokens: %s, cached: %s", usage["input_tokens"], cached_tokens)
+
+def file_digest(file, chunk_size=1024 * 1024):
+    """Content hash of an uploaded file, used as its cache key"""
+    # Hash in chunks so the upload isn't copied into a second bytes object
+    digest = hashlib.blake2b(digest_size=8)
+    file.seek(0)
+    for chunk in iter(lambda: file.read(chunk_size), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+def remove_db_files(paths):
+    """Delete database files along with any journal files next to them"""
+    for path in paths:
+        for suffix in ("", ".wal", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+def db_file_path(app, digest, build_id="*"):
+    """Temporary database file for one build of an upload, or a glob pattern for all its builds"""
+    # The app name keeps the apps sharing the temp dir out of each other's files.
+    # DuckDB hands back a database still open in this process when a path is
+    # reused, even if the file there was replaced, so every build gets its own id
+    return os.path.join(tempfile.gettempdir(), f"q_{app}_{digest}_{build_id}.db")
+
+@st.cache_resource
+def get_db_paths():
+    """build_database's cache keys mapped to their database files, least recently used first, with a lock"""
+    paths = collections.OrderedDict()
+    # Files still listed when the server process exits are deleted then
+    atexit.register(lambda: remove_db_files([path for path in paths.values() if path]))
+    # Every session's script thread updates the same dict
+    return paths, threading.Lock()
+
+# A resource rather than data, so reruns share the database instead of unpickling a copy
+@st.cache_resource(show_spinner=False, max_entries=DB_CACHE_SIZE)
+def build_database(app, digest, file_name, _file, on_disk=False):
+    """Parse an uploaded file into a database once per distinct content, with its summary and file path"""
+    db_path = None
+    if on_disk:
+        # Uploading the same bytes again reopens an earlier build instead of parsing the file
+        for db_path in glob.glob(db_file_path(app, digest)):
+            try:
+                return (*open_db_file(db_path), db_path)
+            except Exception as e:
+                # Left by a killed process or built by the other backend, so start over
+                logger.warning("Rebuilding unreadable database file %s: %s", db_path, e)
+                remove_db_files([db_path])
+        db_path = db_file_path(app, digest, uuid.uuid4().hex[:8])
+    _file.seek(0)
+    return (*create_db_from_file(_file, file_name, db_path=db_path), db_path)
+
+def load_database(app, digest, file_name, file, on_disk=False):
+    """Get an upload's database through build_database's cache, deleting the files of evicted entries"""
+    db, meta, db_path = build_database(app, digest, file_name, file, on_disk)
+    paths, lock = get_db_paths()
+    key = (app, digest, file_name, on_disk)
+    with lock:
+        # Every call is recorded in access order, so the entry dropped here is
+        # the one build_database's LRU cache evicts once it passes DB_CACHE_SIZE
+        paths[key] = db_path
+        paths.move_to_end(key)
+        while len(paths) > DB_CACHE_SIZE:
+            _, evicted = paths.popitem(last=False)
+            # Uploads of the same bytes under another name share the file
+            if evicted and evicted not in paths.values():
+                try:
+                    remove_db_files([evicted])
+                except OSError as e:
+                    # e.g. on Windows while another session still has it open;
+                    # this upload loaded fine, so don't fail it
+                    logger.warning("Could not delete evicted database file %s: %s", evicted, e)
+    return db, meta
+
+@st.fragment
+def render_chat_history():
+    """Display earlier questions and answers as chat messages"""
+    for question, answer in st.session_state.chat_history:
+        with st.chat_message("user"):
+            st.markdown(question)
+        with st.chat_message("assistant"):
+            st.markdown(answer)